@@ -5,3 +5,23 @@ SIMILARITY_THRESHOLD = 0.8
 MAX_PAIRS = 1000
 MAX_NEW_TRIPLETS_PER_BATCH = 20
 PDF_CONTEXT_CHARS = 2000
+N_CLUSTERS = 4  # default k for KMeans node clustering (capped at the number of nodes)
+
+# First-pass chunk packing: several Settings.chunk_size chunks share one extraction request
+CHUNK_PACKING_ENABLED = True
+CHUNK_PACKING_TOKEN_BUDGET = 3000  # max prompt tokens per packed extraction request
+MAX_TRIPLETS_PER_CHUNK = 5
+
+# CSV chat: columnar store location and how much data goes into the prompt
+CSV_STORE_DIR = "data/csv_store"
+CSV_CONTEXT_ROWS = 10
+CSV_TOP_VALUES = 5
+
+# Second-pass pair scheduling (utility/pairs.py schedule_pairs)
+PAIR_SCHEDULING_ENABLED = True
+CANDIDATE_POOL_FACTOR = 3  # score this many x MAX_PAIRS similar pairs before scheduling
+CROSS_CLUSTER_BONUS = 0.05  # added to similarity when the two nodes are in different clusters
+NODE_REPEAT_PENALTY = 0.02  # subtracted per time a node has already been scheduled
+EARLY_STOP_ENABLED = True  # second pass stops once recent batches add few new triplets
+EARLY_STOP_WINDOW = 5  # stop after this many consecutive batches ...
+EARLY_STOP_MIN_NEW_TRIPLETS = 1  # ... each yielding fewer new triplets than this
@@ -3,7 +3,7 @@ import io
 import openai
 import os
 import pdfplumber
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
 from database import Base, engine, SessionLocal
 from models import CSVUpload, CSVRecord, PDFUpload, KnowledgeGraphTriplet, NodeEmbedding
@@ -13,6 +13,7 @@ from datetime import datetime
 from dotenv import load_dotenv
 from utility.extraction import extract_text_from_pdf, process_pdf_to_kg, extract_context_from_csv_records
 from utility.llm import chat_with_llm
+from utility.csv_store import ingest_csv, remove_columnar_store, get_column_stats, fetch_relevant_rows, count_rows, build_csv_context
 from llama_index.core.settings import Settings
 from llama_index.core.indices.knowledge_graph import KnowledgeGraphIndex
 from llama_index.core import Document
@@ -21,6 +22,13 @@ from llama_index.core.query_engine import KnowledgeGraphQueryEngine
 from llama_index.core import StorageContext
 from llama_index.core.graph_stores.simple import SimpleGraphStore
 import time
+from typing import Optional
+import tempfile
+import shutil
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
+from utility.snapshot import export_snapshot, import_snapshot
+from utility.pipeline import run_pipeline, rerun_stage, pipeline_status
 
 load_dotenv()
 
@@ -58,6 +66,7 @@ def read_root():
 @app.post("/upload-csv")
 def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
     # process CSV 
+    csv_upload_id = None
     try:
         contents = file.file.read().decode("utf-8")  # decode into string from bytes
         csv_reader = csv.DictReader(io.StringIO(contents)) # io.StringIO - in-memory buffer
@@ -70,10 +79,12 @@ def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
         db.commit()
         # refresh to get the auto-generated id for the next table
         db.refresh(csv_upload)
+        csv_upload_id = csv_upload.id
 
         # bulk insert each row to CSVRecord table
+        rows = list(csv_reader)
         records = []
-        for row in csv_reader:
+        for row in rows:
             csv_record = CSVRecord(
                 upload_id=csv_upload.id,
                 row_data=row,
@@ -81,11 +92,17 @@ def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
             )
             records.append(csv_record)
         db.add_all(records)
+        db.flush()  # assigns record ids, which the columnar store maps rows to
+        # columnar copy + per-column stats used as chat context
+        ingest_csv(csv_upload.id, csv_reader.fieldnames or [], rows, [r.id for r in records], db)
         db.commit()
         return {"message": "CSV uploaded successfully", "upload_id": csv_upload.id}
     
     except Exception as e:
         db.rollback()
+        if csv_upload_id is not None:
+            # the columnar store is written before the commit; don't leave it behind
+            remove_columnar_store(csv_upload_id)
         raise HTTPException(status_code=400, detail=f"CSV upload failed: {e}")
 
 
@@ -93,6 +110,7 @@ def upload_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
 
 @app.post("/upload-pdf")
 def upload_pdf(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    upload_id = None
     try:
         # 1. Extract text from PDF using utility
         all_text = extract_text_from_pdf(file)
@@ -107,14 +125,19 @@ def upload_pdf(file: UploadFile = File(...), db: Session = Depends(get_db)):
         db.add(pdf_upload)
         db.commit()
         db.refresh(pdf_upload)
+        upload_id = pdf_upload.id
 
-        # 3. Extract triplets from the PDF
+        # 3. Extract triplets from the PDF (checkpointed, see /pipeline endpoints below)
         process_pdf_to_kg(pdf_upload, db)
 
         return {"message": "PDF uploaded successfully", "upload_id": pdf_upload.id}
     except Exception as e:
         db.rollback()
-        raise HTTPException(status_code=400, detail=f"PDF upload failed: {e}\n")
+        detail = f"PDF upload failed: {e}\n"
+        if upload_id is not None:
+            # completed work is checkpointed; resuming continues from where this failed
+            detail += f"Resume with POST /pipeline/{upload_id}/resume (upload_id: {upload_id})\n"
+        raise HTTPException(status_code=400, detail=detail)
 
 
 
@@ -162,18 +185,25 @@ async def chat_csv(request: Request, db: Session = Depends(get_db)):
         upload_id = data.get("upload_id")
         if not question or not upload_id:
             raise HTTPException(status_code=400, detail="Missing question or upload_id")
-        # 1. Retrieve relevant rows from the database
-        records = db.query(CSVRecord).filter(CSVRecord.upload_id == upload_id).all()
+        # 1. Retrieve rows relevant to the question (filter + LIMIT run in the DB)
+        column_stats = get_column_stats(upload_id, db)
+        records, hinted_columns = fetch_relevant_rows(upload_id, question, db, column_stats)
         if not records:
             raise HTTPException(status_code=404, detail="No data found for this upload_id")
-        # 2. Build context from the data (limit to first 10 rows to avoid token limits)
-        context = extract_context_from_csv_records(records)
+        # 2. Build context from the precomputed column stats + retrieved rows
+        if column_stats:
+            context = build_csv_context(column_stats, records, hinted_columns)
+            total_rows = column_stats[0].row_count
+        else:
+            # uploads from before the columnar store only have raw rows
+            context = extract_context_from_csv_records(records)
+            total_rows = count_rows(upload_id, db)
         # 3. Call shared LLM chat utility
         answer = chat_with_llm(question, context, context_type="CSV")
         return {
             "answer": answer,
             "context_used": context,
-            "total_rows": len(records)
+            "total_rows": total_rows
         }
     except Exception as e:
         print("OpenAI error:", e)
@@ -211,6 +241,75 @@ def get_node_embeddings(pdf_id: int, db: Session = Depends(get_db)):
         for ne in node_embeddings
     ]
 
+# SNAPSHOT EXPORT / IMPORT ---------------------------------------------------
+# Same format as `python -m utility.snapshot export|import` (see utility/snapshot.py)
+@app.get("/graph/{pdf_id}/snapshot")
+def export_graph_snapshot(pdf_id: int, db: Session = Depends(get_db)):
+    fd, path = tempfile.mkstemp(suffix=".kgsnap")
+    os.close(fd)
+    try:
+        export_snapshot(pdf_id, db, path)
+    except ValueError as e:
+        os.remove(path)
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(
+        path,
+        media_type="application/octet-stream",
+        filename=f"graph_{pdf_id}.kgsnap",
+        background=BackgroundTask(os.remove, path),  # delete the temp file once sent
+    )
+
+@app.post("/graph/snapshot")
+def import_graph_snapshot(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    fd, path = tempfile.mkstemp(suffix=".kgsnap")
+    try:
+        # spool the upload to disk so the importer can mmap it
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(file.file, f)
+        pdf_upload = import_snapshot(path, db)
+        return {"message": "Snapshot imported successfully", "upload_id": pdf_upload.id}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Snapshot import failed: {e}")
+    finally:
+        os.remove(path)
+
+# PIPELINE ENDPOINTS -----------------------------------------------------------
+# Stages and checkpoints are described in utility/pipeline.py
+def get_pdf_upload_or_404(pdf_id, db):
+    pdf_upload = db.query(PDFUpload).filter(PDFUpload.id == pdf_id).first()
+    if not pdf_upload:
+        raise HTTPException(status_code=404, detail="No PDF found for this upload_id")
+    return pdf_upload
 
+@app.get("/pipeline/{pdf_id}")
+def get_pipeline_status(pdf_id: int, db: Session = Depends(get_db)):
+    get_pdf_upload_or_404(pdf_id, db)
+    return {"upload_id": pdf_id, "stages": pipeline_status(pdf_id, db)}
 
+@app.post("/pipeline/{pdf_id}/resume")
+def resume_pipeline(pdf_id: int, db: Session = Depends(get_db)):
+    pdf_upload = get_pdf_upload_or_404(pdf_id, db)
+    try:
+        run_pipeline(pdf_upload, db)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Pipeline failed: {e}")
+    return {"message": "Pipeline complete", "upload_id": pdf_id, "stages": pipeline_status(pdf_id, db)}
 
+# e.g. POST /pipeline/3/rerun/clusters?n_clusters=6
+@app.post("/pipeline/{pdf_id}/rerun/{stage}")
+def rerun_pipeline_stage(pdf_id: int, stage: str, n_clusters: Optional[int] = Query(None, ge=1), downstream: bool = False,
+                         db: Session = Depends(get_db)):
+    pdf_upload = get_pdf_upload_or_404(pdf_id, db)
+    try:
+        rerun = rerun_stage(pdf_upload, stage, db, downstream=downstream, n_clusters=n_clusters)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Re-running stage '{stage}' failed: {e}")
+    return {
+        "message": f"Stage '{stage}' re-run",
+        "upload_id": pdf_id,
+        "rerun_stages": rerun,
+        "stages": pipeline_status(pdf_id, db),
+    }
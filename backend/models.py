@@ -17,6 +17,23 @@ class CSVRecord(Base):
     row_data = Column(JSONB)
     created_at = Column(DateTime, default=datetime.now)
 
+# Per-column summary computed once at ingest (see utility/csv_store.py)
+class CSVColumnStats(Base):
+    __tablename__ = "csv_column_stats"
+    id = Column(Integer, primary_key=True)
+    upload_id = Column(Integer, ForeignKey("csv_uploads.id"))
+    column_name = Column(String)
+    position = Column(Integer)  # column order in the original file
+    dtype = Column(String)  # "int", "float", "bool" or "string"
+    row_count = Column(Integer)
+    non_null_count = Column(Integer)
+    distinct_count = Column(Integer)
+    min_value = Column(Text)
+    max_value = Column(Text)
+    mean = Column(Float)  # numeric columns only
+    top_values = Column(JSONB)  # [[value, count], ...] most frequent first
+    created_at = Column(DateTime, default=datetime.now)
+
 # ---------------------------------------------------------------------
 
 class PDFUpload(Base):
@@ -46,4 +63,15 @@ class NodeEmbedding(Base):
     node_id = Column(String)
     embedding = Column(JSONB)  # Store the embedding vector as JSON
     cluster_id = Column(Integer)
-    created_at = Column(DateTime, default=datetime.now)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.now)
+
+# Progress of the PDF -> KG pipeline (see utility/pipeline.py).
+# unit_key identifies one unit of work within a stage; "done" marks the whole stage complete.
+class PipelineCheckpoint(Base):
+    __tablename__ = "pipeline_checkpoints"
+    id = Column(Integer, primary_key=True)
+    pdf_upload_id = Column(Integer, ForeignKey("pdf_uploads.id"))
+    stage = Column(String)
+    unit_key = Column(String)
+    payload = Column(JSONB)
+    created_at = Column(DateTime, default=datetime.now)
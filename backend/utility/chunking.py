@@ -0,0 +1,51 @@
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.settings import Settings
+
+# ALL FUNCTIONS TO DO WITH SPLITTING PDF TEXT AND PACKING CHUNKS INTO LLM REQUESTS
+
+def count_tokens(text):
+    """Count tokens using the global llama_index tokenizer (tiktoken for OpenAI models)."""
+    return len(Settings.tokenizer(text))
+
+def split_text_into_chunks(text, chunk_size=None):
+    """
+    Split text into chunks the same way KnowledgeGraphIndex would (sentence-aware, Settings.chunk_size tokens).
+    """
+    splitter = SentenceSplitter(chunk_size=chunk_size or Settings.chunk_size)
+    return [chunk for chunk in splitter.split_text(text) if chunk.strip()]
+
+def pack_chunks(chunks, token_budget, preamble_tokens, segment_overhead_tokens=8):
+    """
+    Greedily pack consecutive chunks into groups so that
+    preamble + sum(chunk tokens + per-segment overhead) stays within token_budget.
+    A chunk that is too big to share a request on its own gets a group to itself.
+    Returns a list of groups, each a list of (chunk_index, chunk_text) tuples.
+    """
+    groups = []
+    current = []
+    current_tokens = preamble_tokens
+    for idx, chunk in enumerate(chunks):
+        chunk_tokens = count_tokens(chunk) + segment_overhead_tokens
+        if current and current_tokens + chunk_tokens > token_budget:
+            groups.append(current)
+            current = []
+            current_tokens = preamble_tokens
+        current.append((idx, chunk))
+        current_tokens += chunk_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def packing_stats(chunks, groups, preamble_tokens, unpacked_preamble_tokens, segment_overhead_tokens=8):
+    """
+    Compare request count and prompt tokens for one-request-per-chunk vs packed requests.
+    preamble_tokens is the packed prompt's preamble, unpacked_preamble_tokens the one-chunk prompt's.
+    """
+    chunk_tokens = sum(count_tokens(chunk) for chunk in chunks)
+    return {
+        "chunks": len(chunks),
+        "unpacked_requests": len(chunks),
+        "packed_requests": len(groups),
+        "unpacked_prompt_tokens": chunk_tokens + unpacked_preamble_tokens * len(chunks),
+        "packed_prompt_tokens": chunk_tokens + preamble_tokens * len(groups) + segment_overhead_tokens * len(chunks),
+    }
@@ -0,0 +1,300 @@
+import json
+import os
+import re
+import shutil
+from collections import Counter
+import numpy as np
+from sqlalchemy import func, literal, or_, select
+from models import CSVRecord, CSVColumnStats
+from config import CSV_STORE_DIR, CSV_CONTEXT_ROWS, CSV_TOP_VALUES
+from utility.snapshot import decode_string
+
+# ALL FUNCTIONS TO DO WITH THE COLUMNAR CSV STORE AND CSV CHAT CONTEXT
+#
+# Layout on disk, one directory per upload:
+#   {CSV_STORE_DIR}/{upload_id}/columns.json         column names + dtypes, in file order
+#   {CSV_STORE_DIR}/{upload_id}/row_ids.npy          int64 CSVRecord.id of each row
+#   {CSV_STORE_DIR}/{upload_id}/{position}.npy       one typed array per column (int64, float64 or bool);
+#                                                    for string columns the UTF-8 bytes of all cells, concatenated
+#   {CSV_STORE_DIR}/{upload_id}/{position}.offsets.npy  string columns only: int64 (n_rows + 1,), cell i is
+#                                                    bytes[offsets[i]:offsets[i + 1]] (same as utility/snapshot.py)
+#   {CSV_STORE_DIR}/{upload_id}/{position}.mask.npy  bool, True where the cell was empty
+# Row i of every column is the CSVRecord with id row_ids[i].
+
+STOPWORDS = {
+    "the", "and", "for", "are", "was", "were", "what", "which", "who", "whom", "how", "many",
+    "much", "does", "did", "with", "from", "that", "this", "there", "their", "have", "has",
+    "all", "any", "show", "list", "give", "tell", "about", "rows", "row", "data", "csv",
+    "where", "when", "than", "into", "average", "mean", "total", "sum", "max", "min",
+    "highest", "lowest", "largest", "smallest", "most", "least", "top", "bottom",
+}
+# question words that ask for the low end of a column rather than the high end
+ASCENDING_WORDS = {"lowest", "smallest", "least", "fewest", "cheapest", "min", "minimum", "bottom"}
+
+# "007", "02134": identifiers/codes, not numbers - parsing them would drop the zeros
+LEADING_ZERO_REGEX = re.compile(r"^[+-]?0\d")
+# stricter than int()/float(), which also accept "1_000", "nan" and "inf"
+INT_REGEX = re.compile(r"^[+-]?\d+$")
+FLOAT_REGEX = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+def infer_column_type(values):
+    """
+    Pick the narrowest type that parses every non-empty value: int, float, bool, else string.
+    Values with leading zeros keep the column a string; ints outside int64 become float.
+    """
+    non_empty = [v.strip() for v in values if v is not None and v.strip() != ""]
+    if not non_empty:
+        return "string"
+    if any(LEADING_ZERO_REGEX.match(v) for v in non_empty):
+        return "string"
+    if all(INT_REGEX.match(v) and INT64_MIN <= int(v) <= INT64_MAX for v in non_empty):
+        return "int"
+    if all(FLOAT_REGEX.match(v) for v in non_empty):
+        return "float"
+    if all(v.lower() in ("true", "false") for v in non_empty):
+        return "bool"
+    return "string"
+
+def to_column_array(values, dtype):
+    """
+    Convert raw CSV strings to a typed numpy array plus a null mask (True = empty cell).
+    Empty cells hold a placeholder (0 / False / "") and must be read through the mask.
+    String columns stay a list of str: a fixed-width numpy str array is sized to the longest cell.
+    """
+    values = [(v or "").strip() for v in values]
+    mask = np.array([v == "" for v in values], dtype=np.bool_)
+    if dtype == "int":
+        array = np.array([int(v) if v else 0 for v in values], dtype=np.int64)
+    elif dtype == "float":
+        array = np.array([float(v) if v else 0.0 for v in values], dtype=np.float64)
+    elif dtype == "bool":
+        array = np.array([v.lower() == "true" for v in values], dtype=np.bool_)
+    else:
+        array = values
+    return array, mask
+
+def encode_strings(values):
+    """UTF-8 bytes of all values concatenated, plus int64 offsets (n + 1,)."""
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def remove_columnar_store(upload_id):
+    """Delete an upload's store, e.g. when the upload's DB transaction is rolled back."""
+    shutil.rmtree(upload_store_dir(upload_id), ignore_errors=True)
+
+def upload_store_dir(upload_id):
+    return os.path.join(CSV_STORE_DIR, str(upload_id))
+
+def write_columnar_store(upload_id, fieldnames, rows, row_ids):
+    """
+    Write one typed .npy file (+ null mask) per column for an upload.
+    Returns a list of (column_name, dtype, values, mask) in file order.
+    """
+    store_dir = upload_store_dir(upload_id)
+    os.makedirs(store_dir, exist_ok=True)
+    np.save(os.path.join(store_dir, "row_ids.npy"), np.array(row_ids, dtype=np.int64))
+    columns = []
+    for position, name in enumerate(fieldnames):
+        raw = [row.get(name) for row in rows]
+        dtype = infer_column_type(raw)
+        values, mask = to_column_array(raw, dtype)
+        if dtype == "string":
+            string_bytes, offsets = encode_strings(values)
+            np.save(os.path.join(store_dir, f"{position}.npy"), string_bytes)
+            np.save(os.path.join(store_dir, f"{position}.offsets.npy"), offsets)
+        else:
+            np.save(os.path.join(store_dir, f"{position}.npy"), values)
+        np.save(os.path.join(store_dir, f"{position}.mask.npy"), mask)
+        columns.append((name, dtype, values, mask))
+    with open(os.path.join(store_dir, "columns.json"), "w") as f:
+        json.dump([{"name": name, "dtype": dtype} for name, dtype, _, _ in columns], f)
+    return columns
+
+def load_columnar_store(upload_id, mmap_mode="r"):
+    """
+    Load an upload's store as (row_ids, {name: (dtype, values, mask)}); arrays are memory-mapped by default.
+    For string columns values is (bytes, offsets); read cell i with column_string(values, i).
+    Returns None if the upload has no columnar store (e.g. uploaded before it existed).
+    """
+    store_dir = upload_store_dir(upload_id)
+    meta_path = os.path.join(store_dir, "columns.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    row_ids = np.load(os.path.join(store_dir, "row_ids.npy"), mmap_mode=mmap_mode)
+    columns = {}
+    for position, col in enumerate(meta):
+        values = np.load(os.path.join(store_dir, f"{position}.npy"), mmap_mode=mmap_mode)
+        if col["dtype"] == "string":
+            values = (values, np.load(os.path.join(store_dir, f"{position}.offsets.npy"), mmap_mode=mmap_mode))
+        mask = np.load(os.path.join(store_dir, f"{position}.mask.npy"), mmap_mode=mmap_mode)
+        columns[col["name"]] = (col["dtype"], values, mask)
+    return row_ids, columns
+
+def column_string(values, i):
+    string_bytes, offsets = values
+    return decode_string(string_bytes, offsets, i)
+
+def format_value(value, dtype):
+    if dtype == "int":
+        return str(int(value))
+    if dtype == "bool":
+        return "true" if value else "false"
+    if dtype == "float":
+        return f"{value:g}"
+    return str(value)
+
+def compute_column_stats(upload_id, columns, top_k=CSV_TOP_VALUES):
+    """
+    Compute per-column stats (counts, min/max, distinct, top values) from the typed arrays.
+    Returns unsaved CSVColumnStats objects.
+    """
+    stats = []
+    for position, (name, dtype, array, mask) in enumerate(columns):
+        if dtype == "string":
+            # plain Python strings; Counter avoids a fixed-width copy of the column
+            counter = Counter(v for v, empty in zip(array, mask) if not empty)
+            non_null = int(sum(counter.values()))
+            distinct = len(counter)
+            top = counter.most_common(top_k)
+            min_value = min(counter) if counter else None
+            max_value = max(counter) if counter else None
+            mean = None
+        else:
+            present = array[~mask]
+            values, counts = np.unique(present, return_counts=True)
+            order = np.argsort(-counts, kind="stable")[:top_k]
+            non_null = int(len(present))
+            distinct = len(values)
+            top = [(values[i], counts[i]) for i in order]
+            # np.unique sorts, so min/max are the ends
+            min_value = values[0] if non_null else None
+            max_value = values[-1] if non_null else None
+            mean = float(present.mean()) if non_null and dtype in ("int", "float") else None
+        stats.append(CSVColumnStats(
+            upload_id=upload_id,
+            column_name=name,
+            position=position,
+            dtype=dtype,
+            row_count=int(len(array)),
+            non_null_count=non_null,
+            distinct_count=int(distinct),
+            min_value=format_value(min_value, dtype) if non_null else None,
+            max_value=format_value(max_value, dtype) if non_null else None,
+            mean=mean,
+            top_values=[[format_value(v, dtype), int(c)] for v, c in top],
+        ))
+    return stats
+
+def ingest_csv(upload_id, fieldnames, rows, row_ids, db):
+    """
+    Build the columnar store and column stats for a freshly uploaded CSV.
+    row_ids are the (flushed) CSVRecord ids of rows, in the same order. The caller commits.
+    """
+    columns = write_columnar_store(upload_id, fieldnames, rows, row_ids)
+    db.add_all(compute_column_stats(upload_id, columns))
+
+def get_column_stats(upload_id, db):
+    return db.query(CSVColumnStats).filter(
+        CSVColumnStats.upload_id == upload_id
+    ).order_by(CSVColumnStats.position).all()
+
+def extract_keywords(question, max_keywords=5):
+    words = re.findall(r"\w+", question.lower())
+    keywords = []
+    for w in words:
+        if len(w) >= 3 and w not in STOPWORDS and w not in keywords:
+            keywords.append(w)
+    return keywords[:max_keywords]
+
+def split_keywords(keywords, column_stats):
+    """
+    Keywords that name a column ("price", "unit_price") say which column the question is about;
+    they would match every row as a filter. Returns (value_keywords, hinted column stats).
+    """
+    value_keywords, hinted = [], []
+    for kw in keywords:
+        named = [
+            s for s in column_stats
+            if kw == s.column_name.lower() or kw in re.findall(r"[a-z0-9]+", s.column_name.lower())
+        ]
+        if named:
+            hinted.extend(s for s in named if s not in hinted)
+        else:
+            value_keywords.append(kw)
+    return value_keywords, hinted
+
+def rank_rows_by_column(upload_id, hinted_columns, question, limit):
+    """
+    Row ids ordered by the first hinted numeric column (descending, or ascending for "lowest" etc.),
+    read from the memory-mapped columnar store. Empty if there is no such column or no store.
+    """
+    store = load_columnar_store(upload_id)
+    if store is None:
+        return []
+    row_ids, columns = store
+    ascending = bool(ASCENDING_WORDS & set(re.findall(r"\w+", question.lower())))
+    for s in hinted_columns:
+        if s.dtype not in ("int", "float") or s.column_name not in columns:
+            continue
+        _, values, mask = columns[s.column_name]
+        present = np.flatnonzero(~mask)
+        order = present[np.argsort(values[present], kind="stable")]
+        if not ascending:
+            order = order[::-1]
+        return [int(row_ids[i]) for i in order[:limit]]
+    return []
+
+def fetch_relevant_rows(upload_id, question, db, column_stats=(), limit=CSV_CONTEXT_ROWS):
+    """
+    Fetch up to `limit` rows for the question. Returns (records, hinted column stats).
+    1. rows with a cell value containing a (non column name) keyword - filter and LIMIT run in the database
+    2. else rows ranked by a numeric column the question names, via the columnar store
+    3. else the first rows
+    """
+    base = db.query(CSVRecord).filter(CSVRecord.upload_id == upload_id)
+    value_keywords, hinted = split_keywords(extract_keywords(question), column_stats)
+    if value_keywords:
+        # match cell values only, not the JSON keys (column names)
+        cells = func.jsonb_each_text(CSVRecord.row_data).table_valued("key", "value").alias("cells")
+        value_matches = select(literal(1)).select_from(cells).where(
+            or_(*[cells.c.value.icontains(kw, autoescape=True) for kw in value_keywords])
+        ).exists()
+        matches = base.filter(value_matches).order_by(CSVRecord.id).limit(limit).all()
+        if matches:
+            return matches, hinted
+    ranked_ids = rank_rows_by_column(upload_id, hinted, question, limit)
+    if ranked_ids:
+        records = base.filter(CSVRecord.id.in_(ranked_ids)).limit(limit).all()
+        position = {row_id: i for i, row_id in enumerate(ranked_ids)}
+        return sorted(records, key=lambda r: position[r.id]), hinted
+    return base.order_by(CSVRecord.id).limit(limit).all(), hinted
+
+def count_rows(upload_id, db):
+    return db.query(func.count(CSVRecord.id)).filter(CSVRecord.upload_id == upload_id).scalar()
+
+def build_csv_context(column_stats, records, hinted_columns=()):
+    """
+    Prompt context: one summary line per column, then the retrieved rows.
+    """
+    lines = [f"Columns ({column_stats[0].row_count} rows total):"]
+    if hinted_columns:
+        lines[0] = f"Columns ({column_stats[0].row_count} rows total; the question refers to: " \
+                   f"{', '.join(s.column_name for s in hinted_columns)}):"
+    for s in column_stats:
+        line = f"- {s.column_name} [{s.dtype}]: {s.non_null_count} non-null, {s.distinct_count} distinct"
+        if s.min_value is not None:
+            line += f", min={s.min_value}, max={s.max_value}"
+        if s.mean is not None:
+            line += f", mean={s.mean:g}"
+        if s.top_values:
+            line += ", top: " + ", ".join(f"{v} ({c})" for v, c in s.top_values)
+        lines.append(line)
+    lines.append("")
+    lines.append(f"Rows relevant to the question ({len(records)} shown):")
+    lines.extend(str(r.row_data) for r in records)
+    return "\n".join(lines)
@@ -16,7 +16,7 @@ from llama_index.embeddings.openai import OpenAIEmbedding
 from datetime import datetime
 import numpy as np
 from llama_index.core.prompts import PromptTemplate, PromptType
-from utility.pairs import get_similar_pairs
+from utility.pairs import get_similar_pairs, get_scheduled_pairs
 import re
 
 # ALL FUNCTIONS TO DO WITH EXTRACTING AND PROCESSING TEXT FROM PDFS
@@ -57,24 +57,62 @@ custom_prompt = PromptTemplate(
     prompt_type=PromptType.KNOWLEDGE_TRIPLET_EXTRACT
 )
 
-from config import SIMILARITY_THRESHOLD, MAX_PAIRS
+# Packed variant of the prompt above: several text segments per request, triplets grouped per segment
+# so each triplet can be attributed back to the chunk it came from.
+PACKED_KG_TRIPLET_EXTRACT_TMPL = (
+    "Several numbered text segments are provided below. For EACH segment, extract up to "
+    "{max_knowledge_triplets} "
+    "knowledge triplets in the form of (subject, predicate, object). Avoid stopwords.\n"
+    "Group your output by segment: write the segment header on its own line, followed by that segment's triplets. "
+    "Only use information from the segment itself. If a segment has no triplets, write its header and nothing else.\n"
+    "---------------------\n"
+    "Example (do NOT include in your output):\n"
+    "[Segment 1]\nAlice is Bob's mother.\n"
+    "[Segment 2]\nPhilz is a coffee shop founded in Berkeley in 1982.\n"
+    "Output:\n"
+    "Segment 1:\n(Alice, is mother of, Bob)\n"
+    "Segment 2:\n(Philz, is, coffee shop)\n(Philz, founded in, Berkeley)\n(Philz, founded in, 1982)\n"
+    "---------------------\n"
+    "{segments}\n"
+    "Output:\n"
+)
+
+TRIPLET_REGEX = re.compile(r"\(\s*['\"]?([^,]+?)['\"]?\s*,\s*['\"]?([^,]+?)['\"]?\s*,\s*['\"]?([^,]+?)['\"]?\s*\)")
+# "Segment 2:", "**Segment 2:**", "[Segment 2]" - alone on the line or directly followed by a "(...)" triplet,
+# so prose such as "Segment 3 of the road, ..." is not a header
+SEGMENT_HEADER_REGEX = re.compile(r"^[^\w(]*segment\s+(\d+)[\]:*\s]*(?=\(|$)", re.IGNORECASE)
+
+def parse_triplet(line, allow_comma_fallback=True):
+    """
+    Parse "(subject, predicate, object)". With allow_comma_fallback, a bare "a, b, c" line is accepted too.
+    """
+    match = TRIPLET_REGEX.search(line)
+    if match:
+        return tuple(part.strip().strip('"\'') for part in match.groups())
+    if allow_comma_fallback and ',' in line:
+        parts = [p.strip().strip('"\'') for p in line.split(',')]
+        if len(parts) == 3:
+            return tuple(parts)
+    return None
+
+from config import (
+    MAX_TRIPLETS_PER_CHUNK,
+    N_CLUSTERS,
+    PAIR_SCHEDULING_ENABLED,
+    EARLY_STOP_ENABLED,
+    EARLY_STOP_WINDOW,
+    EARLY_STOP_MIN_NEW_TRIPLETS,
+)
+from utility.chunking import count_tokens, pack_chunks, packing_stats
 
 def process_pdf_to_kg(pdf_upload: PDFUpload, db: Session):
     """
     Orchestrate the full pipeline: extract text, build KG, store triplets, embeddings, clusters.
+    Runs as checkpointed stages (see utility/pipeline.py), so calling this again after a failure resumes.
     """
-    text = get_pdf_text(pdf_upload)
-    if not text:
-        print("No text found in PDF upload.")
-        return
-    kg_index = build_kg_index(text)
-    triplets = extract_chunk_triplets(kg_index)
-    store_triplets(triplets, pdf_upload, db)
-    store_node_embeddings(kg_index, pdf_upload, db)
-    assign_node_embedding_clusters(pdf_upload.id, db)
-    # second-pass global relationship extraction
-    extract_cross_node_relationships(pdf_upload.id, db, SIMILARITY_THRESHOLD, MAX_PAIRS)
-    remove_specific_nodes(pdf_upload.id, db)
+    # imported here because the pipeline stages are built from the functions in this module
+    from utility.pipeline import run_pipeline
+    run_pipeline(pdf_upload, db)
 
 def get_pdf_text(pdf_upload: PDFUpload):
     text = getattr(pdf_upload, "content", None)
@@ -89,7 +127,7 @@ def build_kg_index(text: str):
     kg_index = KnowledgeGraphIndex.from_documents(
         documents=documents,
         storage_context=storage_context,
-        max_triplets_per_chunk=5,
+        max_triplets_per_chunk=MAX_TRIPLETS_PER_CHUNK,
         include_embeddings=False,
         kg_triple_extract_template=custom_prompt
     )
@@ -114,43 +152,150 @@ def extract_chunk_triplets(kg_index):
     print("Extracted triplets:", triplets)
     return triplets
 
-def store_triplets(triplets, pdf_upload, db):
-    for head, rel, tail in triplets:
+def build_packed_requests(indexed_chunks, token_budget, max_triplets_per_chunk=MAX_TRIPLETS_PER_CHUNK):
+    """
+    Pack chunks into LLM extraction requests up to token_budget,
+    so the few-shot preamble is paid once per request instead of once per chunk.
+    indexed_chunks is a list of (chunk_index, chunk_text).
+    Returns a list of (chunk_indices, prompt); segment N of a prompt is chunk_indices[N - 1].
+    """
+    chunks = [chunk for _, chunk in indexed_chunks]
+    preamble = PACKED_KG_TRIPLET_EXTRACT_TMPL.format(
+        max_knowledge_triplets=max_triplets_per_chunk, segments=""
+    )
+    preamble_tokens = count_tokens(preamble)
+    # what one-call-per-chunk (KnowledgeGraphIndex with custom_prompt) pays per request
+    unpacked_preamble_tokens = count_tokens(CUSTOM_KG_TRIPLET_EXTRACT_TMPL.format(
+        max_knowledge_triplets=max_triplets_per_chunk, text=""
+    ))
+    groups = pack_chunks(chunks, token_budget, preamble_tokens)
+    stats = packing_stats(chunks, groups, preamble_tokens, unpacked_preamble_tokens)
+    print(
+        f"[chunk packing] {stats['chunks']} chunks -> {stats['packed_requests']} requests "
+        f"(was {stats['unpacked_requests']}); prompt tokens ~{stats['packed_prompt_tokens']} "
+        f"(was ~{stats['unpacked_prompt_tokens']})"
+    )
+
+    requests = []
+    for group in groups:
+        # segments are numbered from 1 within each request
+        segments = "\n".join(
+            f"[Segment {n}]\n{chunk}" for n, (_, chunk) in enumerate(group, start=1)
+        )
+        prompt = PACKED_KG_TRIPLET_EXTRACT_TMPL.format(
+            max_knowledge_triplets=max_triplets_per_chunk, segments=segments
+        )
+        requests.append(([indexed_chunks[pos][0] for pos, _ in group], prompt))
+    return requests
+
+def parse_packed_triplet_response(response, segment_texts, max_triplets_per_chunk):
+    """
+    Parse a packed extraction response grouped by "Segment N:" headers.
+    Triplets are attributed to the most recent header; lines before any header are dropped.
+    """
+    triplets = []
+    per_segment = {}
+    current = None
+    for line in response.splitlines():
+        line = line.strip().lstrip("-•* \t").strip()
+        if not line:
+            continue
+        header = SEGMENT_HEADER_REGEX.match(line)
+        if header:
+            n = int(header.group(1))
+            current = n if n in segment_texts else None
+            # the header may share its line with the segment's first triplet
+            line = line[header.end():].strip()
+            if not line:
+                continue
+        if current is None:
+            continue
+        # like KnowledgeGraphIndex, only "(...)" triplets count; bare comma lines are usually prose
+        triplet = parse_triplet(line, allow_comma_fallback=False)
+        if not triplet or not all(triplet):
+            continue
+        if per_segment.get(current, 0) >= max_triplets_per_chunk:
+            continue
+        # same normalisation as KnowledgeGraphIndex so node names match the unpacked path
+        subj, rel, obj = (part.strip().capitalize() for part in triplet)
+        if not subj or not rel or not obj:
+            continue
+        per_segment[current] = per_segment.get(current, 0) + 1
+        triplets.append((subj, rel, obj, segment_texts[current]))
+    return triplets
+
+def get_triplet_nodes(triplets):
+    """Distinct subject/object names in first-seen order (the node set of the graph)."""
+    nodes = {}
+    for triplet in triplets:
+        nodes.setdefault(triplet[0].strip(), None)
+        nodes.setdefault(triplet[2].strip(), None)
+    return list(nodes)
+
+def store_triplets(triplets, pdf_upload, db, commit=True):
+    """
+    Triplets are (subject, relation, object) or (subject, relation, object, source_text).
+    Returns the new row ids.
+    """
+    rows = []
+    for head, rel, tail, *source in triplets:
         triplet = KnowledgeGraphTriplet(
             pdf_upload_id=pdf_upload.id,
             subject=head.strip(),
             relation=rel.strip(),
             object=tail.strip(),
-            source_text=None
+            source_text=source[0] if source else None
         )
-        db.add(triplet)
-    db.commit()
-    print("Triplets committed to DB.")
+        rows.append(triplet)
+    db.add_all(rows)
+    db.flush()  # assigns ids
+    if commit:
+        db.commit()
+        print("Triplets committed to DB.")
+    return [row.id for row in rows]
 
-def store_node_embeddings(kg_index, pdf_upload, db):
+def store_node_embeddings(node_names, pdf_upload, db, batch_size=10):
+    """
+    Embed and store nodes, committing after every batch.
+    Nodes that already have an embedding for this upload are skipped, so a failed run can resume.
+    """
     # use global embed model 
     embed_model = Settings.embed_model
-    graph = kg_index.get_networkx_graph()
-    for node_name in graph.nodes():
-        embedding = embed_model.get_text_embedding(node_name)
-        embedding = list(embedding)
-        node_embedding = NodeEmbedding(
-            pdf_upload_id=pdf_upload.id,
-            node_id=node_name,
-            embedding=embedding,
-            cluster_id=None,
-            created_at=datetime.now()
-        )
-        db.add(node_embedding)
-    db.commit()
+    existing = {
+        node_id for (node_id,) in db.query(NodeEmbedding.node_id).filter(
+            NodeEmbedding.pdf_upload_id == pdf_upload.id
+        ).all()
+    }
+    pending = [name for name in node_names if name not in existing]
+    if existing:
+        print(f"Resuming embeddings: {len(existing)} stored, {len(pending)} to go.")
+    for start in range(0, len(pending), batch_size):
+        names = pending[start:start + batch_size]
+        embeddings = embed_model.get_text_embedding_batch(names)
+        for node_name, embedding in zip(names, embeddings):
+            node_embedding = NodeEmbedding(
+                pdf_upload_id=pdf_upload.id,
+                node_id=node_name,
+                embedding=list(embedding),
+                cluster_id=None,
+                created_at=datetime.now()
+            )
+            db.add(node_embedding)
+        db.commit()
 
-def assign_node_embedding_clusters(pdf_upload_id, db, n_clusters=4):
+def assign_node_embedding_clusters(pdf_upload_id, db, n_clusters=N_CLUSTERS):
     """ 
     Assign cluster IDs to node embeddings in the db. 
+    Returns the number of clusters actually used.
     """
     from sklearn.cluster import KMeans
     # get node embeddings ref. by pdf_upload_id from db 
     node_embeddings = db.query(NodeEmbedding).filter_by(pdf_upload_id=pdf_upload_id).all()
+    if not node_embeddings:
+        print(f"No node embeddings for PDF upload {pdf_upload_id}, skipping clustering.")
+        return 0
+    # KMeans needs at least as many samples as clusters
+    n_clusters = min(n_clusters, len(node_embeddings))
     # just extract the embedding field from node_embeddings
     embeddings = [ne.embedding for ne in node_embeddings]
     # convert embeddings to numpy array
@@ -162,7 +307,7 @@ def assign_node_embedding_clusters(pdf_upload_id, db, n_clusters=4):
     # deal with case where assignment is None
     if labels is None:
         print("Clustering failed: labels_ is None")
-        return
+        return 0
     labels = np.array(labels).flatten()
     # assign cluster labels to node_embeddings
     for node_embedding, cluster_id in zip(node_embeddings, labels):
@@ -170,43 +315,50 @@ def assign_node_embedding_clusters(pdf_upload_id, db, n_clusters=4):
         # (no need to add node_embedding to db, it's already in the db) ??? 
     db.commit()
     print(f"Cluster IDs assigned and committed to DB for PDF upload {pdf_upload_id}.")
+    return n_clusters
 
 # ---------------------------------------------------------------------
 
-def extract_cross_node_relationships(pdf_upload_id, db, similarity_threshold, max_pairs, batch_size=10, max_new_triplets_per_batch=20):
+def select_candidate_pairs(pdf_upload_id, db, similarity_threshold, max_pairs):
+    """Node pairs for the second pass: scheduled (see utility/pairs.py) or plain top-N by similarity."""
+    if PAIR_SCHEDULING_ENABLED:
+        similar_pairs = get_scheduled_pairs(pdf_upload_id, db, similarity_threshold, max_pairs)
+    else:
+        similar_pairs = get_similar_pairs(pdf_upload_id, db, similarity_threshold, max_pairs)
+    print(f"Found {len(similar_pairs)} similar pairs.")
+    return similar_pairs
+
+def extract_cross_node_relationships(pdf_upload_id, db, similarity_threshold, max_pairs, batch_size=10, max_new_triplets_per_batch=20,
+                                     pairs=None, completed_batches=None, on_batch_done=None, commit=True):
     """
     For each candidate node pair, prompt the LLM for a possible relationship, batching pairs for efficiency.
     Includes the PDF content as context in the prompt.
+    With EARLY_STOP_ENABLED, stops once EARLY_STOP_WINDOW batches in a row each add fewer than
+    EARLY_STOP_MIN_NEW_TRIPLETS triplets.
+    commit=False only flushes (the caller decides whether to keep the triplets, e.g. the pairs benchmark).
+    Resuming: `pairs` fixes the candidate list, `completed_batches` ({batch_index: new triplet count}) are skipped,
+    and on_batch_done(batch_index, triplet_ids, added_count) runs just before each batch is committed.
+    Returns a dict with llm_calls, new_triplets and yield_per_call (for the batches run this time).
     """
     llm = Settings.llm
-    similar_pairs = get_similar_pairs(pdf_upload_id, db, similarity_threshold, max_pairs)
-    print(f"Found {len(similar_pairs)} similar pairs.")
+    similar_pairs = pairs if pairs is not None else select_candidate_pairs(pdf_upload_id, db, similarity_threshold, max_pairs)
+    completed_batches = completed_batches or {}
+    stats = {"llm_calls": 0, "new_triplets": 0, "yield_per_call": 0.0, "resumed_batches": 0}
 
     # Fetch PDF content from the database for context
     pdf_upload = db.query(PDFUpload).filter(PDFUpload.id == pdf_upload_id).first()
     if not pdf_upload:
         print(f"No PDF found for id {pdf_upload_id}, skipping cross-node extraction.")
-        return
+        return stats
     pdf_context = pdf_upload.content[:2000]  # Use first 2000 chars as context
 
-    TRIPLET_REGEX = re.compile(r"\(\s*['\"]?([^,]+?)['\"]?\s*,\s*['\"]?([^,]+?)['\"]?\s*,\s*['\"]?([^,]+?)['\"]?\s*\)")
-
-    def parse_triplet(line):
-        match = TRIPLET_REGEX.match(line)
-        if match:
-            return tuple(part.strip().strip('"\'') for part in match.groups())
-        if ',' in line:
-            parts = [p.strip().strip('"\'') for p in line.split(',')]
-            if len(parts) == 3:
-                return tuple(parts)
-        return None
-
     def batch(iterable, n=1):
         l = len(iterable)
         for ndx in range(0, l, n):
             yield iterable[ndx:min(ndx + n, l)]
 
-    for pair_batch in batch(similar_pairs, batch_size):
+    def run_batch(pair_batch):
+        """One LLM call; new triplets are flushed (not committed). Returns their ids."""
         pairs_str = "\n".join([f"- {a}, {b}" for a, b in pair_batch])
         prompt = (
             f"Document context:\n{pdf_context}\n"
@@ -222,10 +374,11 @@ def extract_cross_node_relationships(pdf_upload_id, db, similarity_threshold, ma
             f"Pairs:\n{pairs_str}"
         )
         response = llm.complete(prompt).text.strip()
+        stats["llm_calls"] += 1
         print(f"LLM Batch Response:\n{response}")
         # Parse the LLM's response for triplets
         lines = [line.strip() for line in response.splitlines() if line.strip()]
-        added_count = 0
+        triplet_ids = []
         for line in lines:
             # Remove leading list markers and whitespace
             line = line.lstrip("-•* \t").strip()
@@ -246,19 +399,46 @@ def extract_cross_node_relationships(pdf_upload_id, db, similarity_threshold, ma
                 )
             ).first()
             if not exists:
-                db.add(KnowledgeGraphTriplet(
+                new_triplet = KnowledgeGraphTriplet(
                     pdf_upload_id=pdf_upload_id,
                     subject=triplet[0],
                     relation=triplet[1],
                     object=triplet[2],
                     source_text=None
-                ))
-                db.commit()
-                added_count += 1
+                )
+                db.add(new_triplet)
+                # flush so the duplicate check sees it; the batch commits as one unit
+                db.flush()
+                triplet_ids.append(new_triplet.id)
                 print(f"Added new cross-node triplet: {triplet}")
-            if added_count >= max_new_triplets_per_batch:
+            if len(triplet_ids) >= max_new_triplets_per_batch:
                 print(f"Reached max new triplets ({max_new_triplets_per_batch}) for this batch.")
                 break
+        return triplet_ids
+
+    low_yield_streak = 0
+    for batch_index, pair_batch in enumerate(batch(similar_pairs, batch_size)):
+        if batch_index in completed_batches:
+            added_count = completed_batches[batch_index]
+            stats["resumed_batches"] += 1
+        else:
+            triplet_ids = run_batch(pair_batch)
+            added_count = len(triplet_ids)
+            if on_batch_done:
+                on_batch_done(batch_index, triplet_ids, added_count)
+            if commit:
+                db.commit()
+            stats["new_triplets"] += added_count
+        low_yield_streak = low_yield_streak + 1 if added_count < EARLY_STOP_MIN_NEW_TRIPLETS else 0
+        if EARLY_STOP_ENABLED and low_yield_streak >= EARLY_STOP_WINDOW:
+            print(f"Stopping early: {low_yield_streak} batches in a row added fewer than {EARLY_STOP_MIN_NEW_TRIPLETS} triplets.")
+            break
+
+    if stats["llm_calls"]:
+        stats["yield_per_call"] = stats["new_triplets"] / stats["llm_calls"]
+    print(f"[cross-node] {stats['new_triplets']} new triplets from {stats['llm_calls']} LLM calls "
+          f"({stats['yield_per_call']:.2f} per call, {stats['resumed_batches']} batches resumed)")
+    return stats
 
 
 
@@ -1,16 +1,17 @@
 from llama_index.core.llms import LLM 
+import heapq
+import re
 import numpy as np
-from models import NodeEmbedding
+from models import NodeEmbedding, KnowledgeGraphTriplet, PipelineCheckpoint
+from config import CANDIDATE_POOL_FACTOR, CROSS_CLUSTER_BONUS, NODE_REPEAT_PENALTY
 
 def cosine_similarity(a, b):
     a = np.array(a)
     b = np.array(b)
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
-def get_similar_pairs(pdf_upload_id, db, similarity_threshold=0.5, max_pairs=1000):
-    """Generate candidate node pairs for cross-node relationship extraction, 
-       based on some similarity threshold. Cuz it's too computationally expensive to compare all pairs. 
-    """
+def get_scored_pairs(pdf_upload_id, db, similarity_threshold=0.5, max_pairs=1000):
+    """Like get_similar_pairs, but returns (similarity, (node_a, node_b)) tuples, highest first."""
     node_embeddings = db.query(NodeEmbedding).filter_by(pdf_upload_id=pdf_upload_id).all()
     print(f"[get_similar_pairs] Number of node embeddings: {len(node_embeddings)}")
 
@@ -29,8 +30,180 @@ def get_similar_pairs(pdf_upload_id, db, similarity_threshold=0.5, max_pairs=100
     # sort pairs by similarity, highest first (most similar first)
     scored_pairs.sort(reverse=True)
     print(f"[get_similar_pairs] Number of pairs above threshold: {len(scored_pairs)}")
+    return scored_pairs[:max_pairs]
+
+def get_similar_pairs(pdf_upload_id, db, similarity_threshold=0.5, max_pairs=1000):
+    """Generate candidate node pairs for cross-node relationship extraction, 
+       based on some similarity threshold. Cuz it's too computationally expensive to compare all pairs. 
+    """
     # return top max_pairs pairs
-    result = [pair for _, pair in scored_pairs[:max_pairs]]
+    result = [pair for _, pair in get_scored_pairs(pdf_upload_id, db, similarity_threshold, max_pairs)]
     print(f"[get_similar_pairs] Returning {len(result)} pairs (max_pairs={max_pairs})")
     return result
 
+# PAIR SCHEDULING -------------------------------------------------------------
+
+def normalize_node(name):
+    return re.sub(r"[\W_]+", " ", (name or "").lower()).strip()
+
+def get_adjacent_pairs(pdf_upload_id, db):
+    """Set of frozenset({a, b}) (normalized names) already connected by a triplet, in either direction."""
+    rows = db.query(KnowledgeGraphTriplet.subject, KnowledgeGraphTriplet.object).filter(
+        KnowledgeGraphTriplet.pdf_upload_id == pdf_upload_id
+    ).all()
+    return {frozenset((normalize_node(s), normalize_node(o))) for s, o in rows}
+
+def get_node_clusters(pdf_upload_id, db):
+    rows = db.query(NodeEmbedding.node_id, NodeEmbedding.cluster_id).filter(
+        NodeEmbedding.pdf_upload_id == pdf_upload_id
+    ).all()
+    return {node_id: cluster_id for node_id, cluster_id in rows}
+
+def schedule_pairs(scored_pairs, adjacent, clusters, max_pairs,
+                   cross_cluster_bonus=0.05, node_repeat_penalty=0.02):
+    """
+    Choose which candidate pairs to spend the LLM budget on.
+    - drops pairs already connected by a triplet, and pairs that are the same node under different spelling
+    - prefers pairs that cross clusters (cross_cluster_bonus added to similarity)
+    - spreads the budget across nodes: each time a node is scheduled, its remaining pairs lose node_repeat_penalty
+    Returns (pairs in schedule order, stats dict).
+    """
+    stats = {"candidates": len(scored_pairs), "adjacent": 0, "redundant": 0}
+    heap = []
+    for similarity, (a, b) in scored_pairs:
+        na, nb = normalize_node(a), normalize_node(b)
+        if na == nb:
+            stats["redundant"] += 1
+            continue
+        if frozenset((na, nb)) in adjacent:
+            stats["adjacent"] += 1
+            continue
+        ca, cb = clusters.get(a), clusters.get(b)
+        cross = ca is not None and cb is not None and ca != cb
+        base = float(similarity) + (cross_cluster_bonus if cross else 0.0)
+        # heapq is a min-heap; uses_seen lets stale entries be re-scored lazily
+        heapq.heappush(heap, (-base, 0, a, b, base, cross))
+
+    uses = {}
+    scheduled = []
+    cross_count = 0
+    while heap and len(scheduled) < max_pairs:
+        _, uses_seen, a, b, base, cross = heapq.heappop(heap)
+        current_uses = uses.get(a, 0) + uses.get(b, 0)
+        if current_uses != uses_seen:
+            heapq.heappush(heap, (-(base - node_repeat_penalty * current_uses), current_uses, a, b, base, cross))
+            continue
+        scheduled.append((a, b))
+        cross_count += cross
+        uses[a] = uses.get(a, 0) + 1
+        uses[b] = uses.get(b, 0) + 1
+
+    stats.update({
+        "scheduled": len(scheduled),
+        "cross_cluster": cross_count,
+        "distinct_nodes": len(uses),
+    })
+    return scheduled, stats
+
+def get_scheduled_pairs(pdf_upload_id, db, similarity_threshold, max_pairs):
+    """Candidate pool of CANDIDATE_POOL_FACTOR x max_pairs similar pairs, scheduled down to max_pairs."""
+    scored_pairs = get_scored_pairs(pdf_upload_id, db, similarity_threshold, max_pairs * CANDIDATE_POOL_FACTOR)
+    pairs, stats = schedule_pairs(
+        scored_pairs,
+        get_adjacent_pairs(pdf_upload_id, db),
+        get_node_clusters(pdf_upload_id, db),
+        max_pairs,
+        cross_cluster_bonus=CROSS_CLUSTER_BONUS,
+        node_repeat_penalty=NODE_REPEAT_PENALTY,
+    )
+    print(f"[schedule_pairs] {stats}")
+    return pairs
+
+# BENCHMARK -------------------------------------------------------------------
+# Compares the plain top-N pairs the second pass used to send with the schedule. Run from backend/:
+#   python -m utility.pairs <pdf_id>          pair-list stats only, no LLM calls
+#   python -m utility.pairs <pdf_id> --llm    also runs the second pass on both lists (at most
+#                                             max_pairs / batch_size LLM calls each) and reports yield
+#                                             per LLM call; nothing is saved
+# Both modes first remove the triplets an earlier second pass added (ids from the "cross_node"
+# pipeline checkpoints) inside the session, so the lists are compared on the first-pass graph,
+# then roll everything back.
+# In normal runs the same yield_per_call is logged by extract_cross_node_relationships
+# and stored in the "cross_node" pipeline checkpoint.
+
+def pair_list_stats(pairs, adjacent, clusters):
+    def cluster_of(node):
+        return clusters.get(node)
+    return {
+        "pairs": len(pairs),
+        "adjacent": sum(1 for a, b in pairs if frozenset((normalize_node(a), normalize_node(b))) in adjacent),
+        "redundant": sum(1 for a, b in pairs if normalize_node(a) == normalize_node(b)),
+        "cross_cluster": sum(
+            1 for a, b in pairs
+            if cluster_of(a) is not None and cluster_of(b) is not None and cluster_of(a) != cluster_of(b)
+        ),
+        "distinct_nodes": len({node for pair in pairs for node in pair}),
+    }
+
+def remove_cross_node_triplets(pdf_upload_id, db):
+    """Delete (without committing) the triplets recorded in this upload's cross_node checkpoints."""
+    checkpoints = db.query(PipelineCheckpoint.payload).filter(
+        PipelineCheckpoint.pdf_upload_id == pdf_upload_id,
+        PipelineCheckpoint.stage == "cross_node",
+    ).all()
+    triplet_ids = [i for (payload,) in checkpoints for i in (payload or {}).get("triplet_ids", [])]
+    if triplet_ids:
+        db.query(KnowledgeGraphTriplet).filter(
+            KnowledgeGraphTriplet.pdf_upload_id == pdf_upload_id,
+            KnowledgeGraphTriplet.id.in_(triplet_ids),
+        ).delete(synchronize_session=False)
+    return len(triplet_ids)
+
+def main(argv=None):
+    import argparse
+    from config import SIMILARITY_THRESHOLD, MAX_PAIRS
+    from database import SessionLocal
+    parser = argparse.ArgumentParser(description="Compare naive vs scheduled candidate pairs for a PDF upload.")
+    parser.add_argument("pdf_id", type=int)
+    parser.add_argument("--max-pairs", type=int, default=MAX_PAIRS)
+    parser.add_argument("--llm", action="store_true", help="run the second pass on both lists and report yield per LLM call")
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        removed = remove_cross_node_triplets(args.pdf_id, db)
+        print(f"Benchmarking on the first-pass graph ({removed} second-pass triplets set aside, not deleted).")
+        scored_pairs = get_scored_pairs(args.pdf_id, db, SIMILARITY_THRESHOLD, args.max_pairs * CANDIDATE_POOL_FACTOR)
+        adjacent = get_adjacent_pairs(args.pdf_id, db)
+        clusters = get_node_clusters(args.pdf_id, db)
+        # the plain top-N the second pass used to send
+        naive = [pair for _, pair in scored_pairs[:args.max_pairs]]
+        scheduled, _ = schedule_pairs(
+            scored_pairs, adjacent, clusters, args.max_pairs, CROSS_CLUSTER_BONUS, NODE_REPEAT_PENALTY
+        )
+        results = {"naive": naive, "scheduled": scheduled}
+        for name, pairs in results.items():
+            stats = pair_list_stats(pairs, adjacent, clusters)
+            print(f"{name}: {stats['pairs']} pairs, {stats['adjacent']} already adjacent, {stats['redundant']} redundant, "
+                  f"{stats['cross_cluster']} cross-cluster, {stats['distinct_nodes']} distinct nodes")
+
+        if args.llm:
+            from utility.extraction import extract_cross_node_relationships
+            # each run is capped at max_pairs / batch_size LLM calls; it can make fewer when its list is
+            # shorter (scheduling drops pairs) or EARLY_STOP_ENABLED ends it early, so compare per call
+            for name, pairs in results.items():
+                run = db.begin_nested()
+                stats = extract_cross_node_relationships(
+                    args.pdf_id, db, SIMILARITY_THRESHOLD, args.max_pairs, pairs=pairs, commit=False
+                )
+                # undo this run (savepoint) so the other list starts from the same first-pass graph
+                run.rollback()
+                print(f"{name}: {stats['new_triplets']} new triplets from {stats['llm_calls']} LLM calls, "
+                      f"yield_per_call={stats['yield_per_call']:.2f}")
+    finally:
+        # restores the set-aside second-pass triplets
+        db.rollback()
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+from llama_index.core.settings import Settings
+from models import PDFUpload, KnowledgeGraphTriplet, NodeEmbedding, PipelineCheckpoint
+from utility.chunking import split_text_into_chunks
+from utility.extraction import (
+    get_pdf_text,
+    build_kg_index,
+    extract_chunk_triplets,
+    build_packed_requests,
+    parse_packed_triplet_response,
+    get_triplet_nodes,
+    store_triplets,
+    store_node_embeddings,
+    assign_node_embedding_clusters,
+    select_candidate_pairs,
+    extract_cross_node_relationships,
+    remove_specific_nodes,
+)
+from config import (
+    SIMILARITY_THRESHOLD,
+    MAX_PAIRS,
+    CHUNK_PACKING_ENABLED,
+    CHUNK_PACKING_TOKEN_BUDGET,
+    MAX_TRIPLETS_PER_CHUNK,
+    N_CLUSTERS,
+)
+
+# THE PDF -> KG PIPELINE AS CHECKPOINTED STAGES
+#
+# Every stage records its progress in pipeline_checkpoints, so a failed upload (rate limit, crash, restart)
+# resumes from the last completed unit of work instead of paying for every LLM / embedding call again.
+#
+#   chunks      split text                        checkpoint: chunk texts
+#   extraction  first-pass LLM calls              checkpoint: raw response per packed request
+#   triplets    parse responses, store triplets   checkpoint: ids of the stored triplets
+#   embeddings  embed nodes                       checkpoint: the node_embeddings rows (committed per batch)
+#   clusters    KMeans over node embeddings       checkpoint: k used (labels live in node_embeddings)
+#   pairs       choose second-pass pairs          checkpoint: the pair list
+#   cross_node  second-pass LLM calls             checkpoint: new triplet ids per pair batch
+#   cleanup     drop the few-shot example triplets
+
+STAGES = ["chunks", "extraction", "triplets", "embeddings", "clusters", "pairs", "cross_node", "cleanup"]
+DONE = "done"
+
+# stages that read an earlier stage's checkpoint (the rest read from the graph tables)
+STAGE_INPUTS = {"extraction": "chunks", "triplets": "extraction", "cross_node": "pairs"}
+
+# stages that can re-run on their own. Re-running any other stage invalidates what follows
+# (e.g. new embeddings drop the cluster ids, new triplets can bring back the few-shot example
+# triplets that cleanup removes), so later stages re-run with it.
+# Re-running clusters alone keeps the graph consistent but leaves the "pairs" checkpoint with a
+# schedule built from the old cluster ids (the scheduler's cross-cluster bonus); pass
+# downstream=True to rebuild the schedule and re-run the second pass as well.
+STANDALONE_STAGES = {"clusters", "cleanup"}
+
+# CHECKPOINT HELPERS ------------------------------------------------------------
+
+def get_checkpoints(pdf_upload_id, stage, db):
+    return db.query(PipelineCheckpoint).filter(
+        PipelineCheckpoint.pdf_upload_id == pdf_upload_id,
+        PipelineCheckpoint.stage == stage,
+        PipelineCheckpoint.unit_key != DONE,
+    ).order_by(PipelineCheckpoint.id).all()
+
+def get_checkpoint(pdf_upload_id, stage, unit_key, db):
+    return db.query(PipelineCheckpoint).filter(
+        PipelineCheckpoint.pdf_upload_id == pdf_upload_id,
+        PipelineCheckpoint.stage == stage,
+        PipelineCheckpoint.unit_key == unit_key,
+    ).first()
+
+def save_checkpoint(pdf_upload_id, stage, unit_key, payload, db):
+    """Add a checkpoint to the session; the caller commits it together with the work it records."""
+    db.add(PipelineCheckpoint(
+        pdf_upload_id=pdf_upload_id,
+        stage=stage,
+        unit_key=unit_key,
+        payload=payload,
+    ))
+
+def is_stage_done(pdf_upload_id, stage, db):
+    return get_checkpoint(pdf_upload_id, stage, DONE, db) is not None
+
+def mark_stage_done(pdf_upload_id, stage, db, payload=None):
+    save_checkpoint(pdf_upload_id, stage, DONE, payload or {}, db)
+    db.commit()
+    print(f"[pipeline] PDF {pdf_upload_id}: stage '{stage}' done.")
+
+def delete_checkpoints(pdf_upload_id, stage, db):
+    db.query(PipelineCheckpoint).filter(
+        PipelineCheckpoint.pdf_upload_id == pdf_upload_id,
+        PipelineCheckpoint.stage == stage,
+    ).delete(synchronize_session=False)
+
+def load_chunks(pdf_upload_id, db):
+    return get_checkpoint(pdf_upload_id, "chunks", DONE, db).payload["chunks"]
+
+# STAGES ------------------------------------------------------------------------
+
+def run_chunks_stage(pdf_upload, db, **options):
+    text = get_pdf_text(pdf_upload)
+    if not text:
+        raise ValueError("No text found in PDF upload.")
+    chunks = split_text_into_chunks(text)
+    mark_stage_done(pdf_upload.id, "chunks", db, {"chunks": chunks})
+
+def run_extraction_stage(pdf_upload, db, **options):
+    if not CHUNK_PACKING_ENABLED:
+        # KnowledgeGraphIndex chunks and calls the LLM internally, so the whole pass is one unit
+        if not get_checkpoint(pdf_upload.id, "extraction", "all", db):
+            kg_index = build_kg_index(get_pdf_text(pdf_upload))
+            triplets = extract_chunk_triplets(kg_index)
+            save_checkpoint(pdf_upload.id, "extraction", "all", {"triplets": [list(t) for t in triplets]}, db)
+        mark_stage_done(pdf_upload.id, "extraction", db)
+        return
+
+    llm = Settings.llm
+    chunks = load_chunks(pdf_upload.id, db)
+    done_chunks = set()
+    for checkpoint in get_checkpoints(pdf_upload.id, "extraction", db):
+        done_chunks.update(checkpoint.payload.get("chunk_indices", []))
+    pending = [(i, chunk) for i, chunk in enumerate(chunks) if i not in done_chunks]
+    if done_chunks:
+        print(f"Resuming extraction: {len(done_chunks)} chunks done, {len(pending)} to go.")
+    for chunk_indices, prompt in build_packed_requests(pending, CHUNK_PACKING_TOKEN_BUDGET):
+        response = llm.complete(prompt).text.strip()
+        save_checkpoint(
+            pdf_upload.id, "extraction", f"{chunk_indices[0]}-{chunk_indices[-1]}",
+            {"chunk_indices": chunk_indices, "response": response}, db
+        )
+        db.commit()
+    mark_stage_done(pdf_upload.id, "extraction", db)
+
+def run_triplets_stage(pdf_upload, db, **options):
+    legacy = get_checkpoint(pdf_upload.id, "extraction", "all", db)
+    if legacy:
+        triplets = [tuple(t) for t in legacy.payload["triplets"]]
+    else:
+        chunks = load_chunks(pdf_upload.id, db)
+        triplets = []
+        for checkpoint in get_checkpoints(pdf_upload.id, "extraction", db):
+            segment_texts = {
+                n: chunks[i] for n, i in enumerate(checkpoint.payload["chunk_indices"], start=1)
+            }
+            triplets.extend(parse_packed_triplet_response(
+                checkpoint.payload["response"], segment_texts, MAX_TRIPLETS_PER_CHUNK
+            ))
+    print(f"Extracted {len(triplets)} triplets.")
+    # triplets and the checkpoint holding their ids commit together
+    triplet_ids = store_triplets(triplets, pdf_upload, db, commit=False)
+    mark_stage_done(pdf_upload.id, "triplets", db, {"triplet_ids": triplet_ids})
+
+def run_embeddings_stage(pdf_upload, db, **options):
+    rows = db.query(
+        KnowledgeGraphTriplet.subject,
+        KnowledgeGraphTriplet.relation,
+        KnowledgeGraphTriplet.object,
+    ).filter(KnowledgeGraphTriplet.pdf_upload_id == pdf_upload.id).order_by(KnowledgeGraphTriplet.id).all()
+    store_node_embeddings(get_triplet_nodes(rows), pdf_upload, db)
+    mark_stage_done(pdf_upload.id, "embeddings", db)
+
+def run_clusters_stage(pdf_upload, db, n_clusters=None, **options):
+    used = assign_node_embedding_clusters(pdf_upload.id, db, n_clusters or N_CLUSTERS)
+    mark_stage_done(pdf_upload.id, "clusters", db, {"n_clusters": used})
+
+def run_pairs_stage(pdf_upload, db, **options):
+    pairs = select_candidate_pairs(pdf_upload.id, db, SIMILARITY_THRESHOLD, MAX_PAIRS)
+    mark_stage_done(pdf_upload.id, "pairs", db, {"pairs": [list(p) for p in pairs]})
+
+def run_cross_node_stage(pdf_upload, db, **options):
+    pairs = [tuple(p) for p in get_checkpoint(pdf_upload.id, "pairs", DONE, db).payload["pairs"]]
+    completed = {
+        int(checkpoint.unit_key): checkpoint.payload["added"]
+        for checkpoint in get_checkpoints(pdf_upload.id, "cross_node", db)
+    }
+
+    def on_batch_done(batch_index, triplet_ids, added_count):
+        save_checkpoint(pdf_upload.id, "cross_node", str(batch_index), {"triplet_ids": triplet_ids, "added": added_count}, db)
+
+    stats = extract_cross_node_relationships(
+        pdf_upload.id, db, SIMILARITY_THRESHOLD, MAX_PAIRS,
+        pairs=pairs, completed_batches=completed, on_batch_done=on_batch_done
+    )
+    mark_stage_done(pdf_upload.id, "cross_node", db, stats)
+
+def run_cleanup_stage(pdf_upload, db, **options):
+    remove_specific_nodes(pdf_upload.id, db)
+    mark_stage_done(pdf_upload.id, "cleanup", db)
+
+STAGE_RUNNERS = {
+    "chunks": run_chunks_stage,
+    "extraction": run_extraction_stage,
+    "triplets": run_triplets_stage,
+    "embeddings": run_embeddings_stage,
+    "clusters": run_clusters_stage,
+    "pairs": run_pairs_stage,
+    "cross_node": run_cross_node_stage,
+    "cleanup": run_cleanup_stage,
+}
+
+# RESETTING A STAGE ---------------------------------------------------------------
+
+def delete_triplets(pdf_upload_id, triplet_ids, db):
+    if triplet_ids:
+        db.query(KnowledgeGraphTriplet).filter(
+            KnowledgeGraphTriplet.pdf_upload_id == pdf_upload_id,
+            KnowledgeGraphTriplet.id.in_(triplet_ids),
+        ).delete(synchronize_session=False)
+
+def reset_stage(pdf_upload_id, stage, db):
+    """Undo a stage's side effects and drop its checkpoints (no commit)."""
+    if stage == "triplets":
+        done = get_checkpoint(pdf_upload_id, "triplets", DONE, db)
+        if done:
+            delete_triplets(pdf_upload_id, done.payload.get("triplet_ids", []), db)
+    elif stage == "embeddings":
+        db.query(NodeEmbedding).filter(
+            NodeEmbedding.pdf_upload_id == pdf_upload_id
+        ).delete(synchronize_session=False)
+    elif stage == "clusters":
+        db.query(NodeEmbedding).filter(
+            NodeEmbedding.pdf_upload_id == pdf_upload_id
+        ).update({NodeEmbedding.cluster_id: None}, synchronize_session=False)
+    elif stage == "cross_node":
+        for checkpoint in get_checkpoints(pdf_upload_id, "cross_node", db):
+            delete_triplets(pdf_upload_id, checkpoint.payload.get("triplet_ids", []), db)
+    delete_checkpoints(pdf_upload_id, stage, db)
+
+# ENTRY POINTS ------------------------------------------------------------------------
+
+def run_pipeline(pdf_upload: PDFUpload, db, **options):
+    """
+    Run every stage that has not completed yet, in order. Safe to call again after a failure.
+    """
+    for stage in STAGES:
+        if is_stage_done(pdf_upload.id, stage, db):
+            continue
+        print(f"[pipeline] PDF {pdf_upload.id}: running stage '{stage}'.")
+        STAGE_RUNNERS[stage](pdf_upload, db, **options)
+
+def missing_inputs(pdf_upload_id, stage, db):
+    """Why `stage` cannot run from the checkpoints that exist now (None if it can)."""
+    if stage == "extraction":
+        checkpoint = get_checkpoint(pdf_upload_id, "chunks", DONE, db)
+        if not checkpoint or "chunks" not in (checkpoint.payload or {}):
+            return "there is no chunks checkpoint"
+    elif stage == "triplets":
+        if not get_checkpoint(pdf_upload_id, "extraction", "all", db) and not get_checkpoints(pdf_upload_id, "extraction", db):
+            return "the raw extraction responses are not checkpointed (e.g. an imported snapshot)"
+    elif stage == "cross_node":
+        checkpoint = get_checkpoint(pdf_upload_id, "pairs", DONE, db)
+        if not checkpoint or "pairs" not in (checkpoint.payload or {}):
+            return "the candidate pair list is not checkpointed (e.g. an imported snapshot)"
+    return None
+
+def missing_reset_data(pdf_upload_id, stage, db):
+    """Why `stage`'s output cannot be removed cleanly before a re-run (None if it can)."""
+    if stage == "triplets":
+        checkpoint = get_checkpoint(pdf_upload_id, "triplets", DONE, db)
+        if checkpoint and "triplet_ids" not in (checkpoint.payload or {}):
+            # re-running would store a second copy of the graph next to the old triplets
+            return "the ids of the stored triplets are not recorded"
+    return None
+
+def rerun_stage(pdf_upload: PDFUpload, stage, db, downstream=False, **options):
+    """
+    Re-run a stage (e.g. clusters with a different n_clusters) without recomputing earlier stages.
+    Stages outside STANDALONE_STAGES always reset and re-run the later stages too;
+    for standalone stages downstream=True does the same. Returns the stages that were re-run.
+    """
+    if stage not in STAGE_RUNNERS:
+        raise ValueError(f"Unknown stage '{stage}'. Stages: {', '.join(STAGES)}")
+    if stage not in STANDALONE_STAGES and not downstream:
+        print(f"[pipeline] PDF {pdf_upload.id}: stage '{stage}' invalidates later stages, re-running them too.")
+        downstream = True
+    stages = STAGES[STAGES.index(stage):] if downstream else [stage]
+    # refuse before anything is reset: a failed check must leave the upload as it was
+    for s in stages:
+        required = STAGE_INPUTS.get(s)
+        if required and required not in stages:
+            problem = missing_inputs(pdf_upload.id, s, db)
+            if problem:
+                raise ValueError(f"Cannot re-run stage '{s}': {problem}. Re-run from an earlier stage instead.")
+        problem = missing_reset_data(pdf_upload.id, s, db)
+        if problem:
+            raise ValueError(f"Cannot re-run stage '{s}': {problem}. Re-run from an earlier stage instead.")
+    for s in reversed(stages):
+        reset_stage(pdf_upload.id, s, db)
+    db.commit()
+    for s in stages:
+        print(f"[pipeline] PDF {pdf_upload.id}: re-running stage '{s}'.")
+        STAGE_RUNNERS[s](pdf_upload, db, **options)
+    return stages
+
+def pipeline_status(pdf_upload_id, db):
+    """Per stage: whether it completed and how many units of work are checkpointed."""
+    return {
+        stage: {
+            "done": is_stage_done(pdf_upload_id, stage, db),
+            "units": len(get_checkpoints(pdf_upload_id, stage, db)),
+        }
+        for stage in STAGES
+    }
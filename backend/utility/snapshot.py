@@ -0,0 +1,248 @@
+import argparse
+import json
+import struct
+from datetime import datetime
+import numpy as np
+from sqlalchemy import insert
+from models import PDFUpload, KnowledgeGraphTriplet, NodeEmbedding, PipelineCheckpoint
+
+# ALL FUNCTIONS TO DO WITH EXPORTING / IMPORTING A PROCESSED UPLOAD AS ONE SNAPSHOT FILE
+#
+# File layout (little-endian):
+#   8 bytes   magic b"KGSNAP01"
+#   8 bytes   uint64 header length
+#   header    JSON: upload metadata + {name: {dtype, shape, offset}} for every array
+#   padding   so every array starts on a 64-byte boundary (offsets are relative to the
+#             first 64-byte boundary after the header)
+#   arrays    raw buffers, readable in place with np.memmap
+#
+# Arrays:
+#   string_bytes    uint8  UTF-8 of every node name / relation / source text, concatenated
+#   string_offsets  int64  (n_strings + 1,) start of string i is string_offsets[i]
+#   triplets        int32  (n_triplets, 4) subject, relation, object, source_text (-1 = none)
+#   embedding_nodes int32  (n_nodes,) string index of each embedded node
+#   embeddings      float32 (n_nodes, dim)
+#   cluster_ids     int32  (n_nodes,) -1 = not clustered
+#   content         uint8  UTF-8 of the full PDF text
+
+SNAPSHOT_MAGIC = b"KGSNAP01"
+SNAPSHOT_ALIGN = 64
+
+class StringTable:
+    """Interns strings so each distinct node/relation/source text is stored once."""
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return -1
+        if s not in self.index:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+    def to_arrays(self):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        return np.frombuffer(b"".join(encoded), dtype="u1"), offsets
+
+def decode_string(string_bytes, string_offsets, i):
+    if i < 0:
+        return None
+    return bytes(string_bytes[string_offsets[i]:string_offsets[i + 1]]).decode("utf-8")
+
+def decode_strings(string_bytes, string_offsets):
+    return [decode_string(string_bytes, string_offsets, i) for i in range(len(string_offsets) - 1)]
+
+def align(n):
+    return (n + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+def data_start(header_len):
+    return align(len(SNAPSHOT_MAGIC) + 8 + header_len)
+
+def write_snapshot(path, meta, arrays):
+    """
+    Write arrays (name -> np.ndarray) plus JSON-serialisable meta to a single snapshot file.
+    Array offsets in the header are relative to the (aligned) end of the header.
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset = align(offset + arr.nbytes)
+    header = json.dumps({"meta": meta, "arrays": layout}).encode("utf-8")
+    start = data_start(len(header))
+    with open(path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (start + layout[name]["offset"] - f.tell()))
+            f.write(arr.tobytes())
+
+def read_snapshot(path):
+    """
+    Open a snapshot without copying: every array is an np.memmap over the file.
+    Returns (meta, {name: array}).
+    """
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a graph snapshot")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    start = data_start(header_len)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            # np.memmap refuses zero-length maps
+            arrays[name] = np.empty(shape, dtype=entry["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=entry["dtype"], mode="r", offset=start + entry["offset"], shape=shape)
+    return header["meta"], arrays
+
+def export_snapshot(pdf_upload_id, db, path):
+    """
+    Export one processed upload (PDF text, triplets, node embeddings, clusters) to a snapshot file.
+    """
+    pdf_upload = db.query(PDFUpload).filter(PDFUpload.id == pdf_upload_id).first()
+    if not pdf_upload:
+        raise ValueError(f"No PDF found for id {pdf_upload_id}")
+    # plain column tuples, no ORM objects
+    triplet_rows = db.query(
+        KnowledgeGraphTriplet.subject,
+        KnowledgeGraphTriplet.relation,
+        KnowledgeGraphTriplet.object,
+        KnowledgeGraphTriplet.source_text,
+    ).filter(KnowledgeGraphTriplet.pdf_upload_id == pdf_upload_id).order_by(KnowledgeGraphTriplet.id).all()
+    node_rows = db.query(
+        NodeEmbedding.node_id,
+        NodeEmbedding.embedding,
+        NodeEmbedding.cluster_id,
+    ).filter(NodeEmbedding.pdf_upload_id == pdf_upload_id).order_by(NodeEmbedding.id).all()
+
+    table = StringTable()
+    triplets = np.array(
+        [[table.add(s), table.add(r), table.add(o), table.add(src)] for s, r, o, src in triplet_rows],
+        dtype="<i4",
+    ).reshape(-1, 4)
+    embedding_nodes = np.array([table.add(node_id) for node_id, _, _ in node_rows], dtype="<i4")
+    dim = len(node_rows[0][1]) if node_rows else 0
+    embeddings = np.array([emb for _, emb, _ in node_rows], dtype="<f4").reshape(len(node_rows), dim)
+    cluster_ids = np.array([-1 if c is None else c for _, _, c in node_rows], dtype="<i4")
+    string_bytes, string_offsets = table.to_arrays()
+    content = np.frombuffer((pdf_upload.content or "").encode("utf-8"), dtype="u1")
+
+    meta = {
+        "filename": pdf_upload.filename,
+        "source_upload_id": pdf_upload.id,
+        "exported_at": datetime.now().isoformat(),
+    }
+    write_snapshot(path, meta, {
+        "string_bytes": string_bytes,
+        "string_offsets": string_offsets,
+        "triplets": triplets,
+        "embedding_nodes": embedding_nodes,
+        "embeddings": embeddings,
+        "cluster_ids": cluster_ids,
+        "content": content,
+    })
+    print(f"Exported PDF {pdf_upload_id}: {len(triplets)} triplets, {len(embedding_nodes)} nodes -> {path}")
+
+def import_snapshot(path, db):
+    """
+    Bulk-load a snapshot into a new PDFUpload. Returns the new upload.
+    """
+    meta, arrays = read_snapshot(path)
+    strings = decode_strings(arrays["string_bytes"], arrays["string_offsets"])
+
+    def lookup(i):
+        return strings[i] if i >= 0 else None
+    pdf_upload = PDFUpload(
+        filename=meta.get("filename"),
+        content=bytes(arrays["content"]).decode("utf-8"),
+        created_at=datetime.now()
+    )
+    db.add(pdf_upload)
+    db.flush()  # get the id without committing, so a failed import leaves nothing behind
+
+    now = datetime.now()
+    triplet_rows = [
+        {
+            "pdf_upload_id": pdf_upload.id,
+            "subject": lookup(s),
+            "relation": lookup(r),
+            "object": lookup(o),
+            "source_text": lookup(src),
+            "created_at": now,
+        }
+        for s, r, o, src in arrays["triplets"].tolist()
+    ]
+    node_rows = [
+        {
+            "pdf_upload_id": pdf_upload.id,
+            "node_id": lookup(node),
+            "embedding": embedding,
+            "cluster_id": cluster if cluster >= 0 else None,
+            "created_at": now,
+        }
+        for node, embedding, cluster in zip(
+            arrays["embedding_nodes"].tolist(), arrays["embeddings"].tolist(), arrays["cluster_ids"].tolist()
+        )
+    ]
+    triplet_ids = []
+    if triplet_rows:
+        triplet_ids = db.scalars(insert(KnowledgeGraphTriplet).returning(KnowledgeGraphTriplet.id), triplet_rows).all()
+    if node_rows:
+        db.execute(insert(NodeEmbedding), node_rows)
+
+    # the snapshot is a finished graph: mark every pipeline stage done so a resume doesn't redo the work.
+    # chunks (rebuilt from the text) and the triplet ids are real checkpoints, so re-running from
+    # chunks can replace the imported graph; the raw LLM responses and pair list are not in the
+    # snapshot, so rerun_stage refuses stages that need them (re-run from an earlier stage instead).
+    from utility.pipeline import STAGES, DONE
+    from utility.chunking import split_text_into_chunks
+    payloads = {stage: {"imported": True} for stage in STAGES}
+    payloads["chunks"] = {"imported": True, "chunks": split_text_into_chunks(pdf_upload.content) if pdf_upload.content else []}
+    payloads["triplets"] = {"imported": True, "triplet_ids": list(triplet_ids)}
+    db.execute(insert(PipelineCheckpoint), [
+        {"pdf_upload_id": pdf_upload.id, "stage": stage, "unit_key": DONE, "payload": payloads[stage], "created_at": now}
+        for stage in STAGES
+    ])
+    db.commit()
+    db.refresh(pdf_upload)
+    print(f"Imported {path}: {len(triplet_rows)} triplets, {len(node_rows)} nodes -> PDF {pdf_upload.id}")
+    return pdf_upload
+
+# CLI -----------------------------------------------------------------------
+# Run from backend/:
+#   python -m utility.snapshot export <pdf_id> <path>
+#   python -m utility.snapshot import <path>
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export/import knowledge graph snapshots.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_cmd = sub.add_parser("export", help="write a processed PDF upload to a snapshot file")
+    export_cmd.add_argument("pdf_id", type=int)
+    export_cmd.add_argument("path")
+    import_cmd = sub.add_parser("import", help="load a snapshot file as a new PDF upload")
+    import_cmd.add_argument("path")
+    args = parser.parse_args(argv)
+
+    from database import Base, engine, SessionLocal
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if args.command == "export":
+            export_snapshot(args.pdf_id, db, args.path)
+        else:
+            pdf_upload = import_snapshot(args.path, db)
+            print(f"upload_id: {pdf_upload.id}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()